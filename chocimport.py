@@ -29,153 +29,535 @@ possible styles of usage, but the most common ones:
 8) (x => ABBR(x.attr, x.text))(stuff)
 9) replace_content in any context where set_content is valid
 """
+import collections
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
 import sys
 import esprima # ImportError? pip install -r requirements.txt
 
+# esprima's node base class answers None for every unknown attribute, which
+# breaks unpickling (pickle finds a __setstate__ of None and calls it). Give
+# it a real one so parsed trees can be cached.
+esprima.nodes.Object.__setstate__ = lambda self, state: self.__dict__.update(state)
+
+# If available, parse with tree-sitter (compiled C) rather than esprima (pure
+# Python) - it's orders of magnitude faster on large files. The tree gets
+# dressed up to look like an esprima tree, so everything below is unaware of
+# which parser produced it; --legacy-parser forces esprima.
+try:
+	import tree_sitter, tree_sitter_javascript
+	_ts_lang = tree_sitter.Language(tree_sitter_javascript.language())
+	_ts_parser = tree_sitter.Parser(_ts_lang)
+except Exception: # ImportError, or an incompatible tree_sitter API
+	_ts_parser = None
+
 DOM_ADDITION_METHODS = ("appendChild", "before", "after", "append", "prepend", "insertBefore", "replaceWith")
 DEFAULT_NAMESPACES = {"SVG": "svg"}
 NAMESPACE_XFRM = {"svg": lambda fn: fn.lower()}
 
 class Ctx:
-	@classmethod
-	def reset(cls, fn="-"):
-		Ctx.autoimport_line = -1 # If we find "//autoimport" at the end of a line, any declaration surrounding that will be edited.
-		Ctx.autoimport_range = None
-		Ctx.got_imports, Ctx.want_imports, Ctx.import_namespaces = { }, { }, { }
-		Ctx.import_source = "choc" # Will be set to "lindt" if the file uses lindt/replace_content
-		Ctx.fn = fn
-		Ctx.source_lines = []
+	"""Per-file analysis state
+
+	One instance per file scanned. The results (imports had and wanted) stay
+	on the instance afterwards, so library callers can inspect them."""
+	def __init__(self, fn="-"):
+		self.autoimport_line = -1 # If we find "//autoimport" at the end of a line, any declaration surrounding that will be edited.
+		self.autoimport_range = None
+		self.got_imports, self.import_namespaces = { }, { }
+		self.want_imports = set()
+		self.want_namespaced = { } # Name -> quoted "ns:element" source, for the few namespaced imports
+		self.import_source = "choc" # Will be set to "lindt" if the file uses lindt/replace_content
+		self.fn = fn
+		self.source = ""
+		self.source_lines = None # Split from source on demand - most files never need it
+		self.visited = set() # (id(el), sc) pairs already descended into
+
+	def source_line(self, n):
+		"""Get the nth (1-based) line of this file, splitting lazily"""
+		if self.source_lines is None: self.source_lines = self.source.split("\n")
+		return self.source_lines[n - 1]
+
+_ast_db = None
+def _ast_cache():
+	"""Get a connection to the on-disk AST cache, opening it if necessary
+
+	Parsing is by far the slowest part of this job, so parsed trees are kept
+	in ~/.cache/choc/ast.sqlite, keyed by file path and content hash. A stale
+	entry is simply never looked up again (the hash won't match), so there's
+	no explicit invalidation."""
+	global _ast_db
+	if _ast_db is None:
+		cachedir = os.path.join(os.path.expanduser("~"), ".cache", "choc")
+		os.makedirs(cachedir, exist_ok=True)
+		_ast_db = sqlite3.connect(os.path.join(cachedir, "ast.sqlite"))
+		_ast_db.execute("pragma journal_mode=wal")
+		_ast_db.execute("""create table if not exists ast (
+			path text, sha text, esprima text, tree blob,
+			primary key (path, sha))""")
+	return _ast_db
+
+# Duplicate content within a single run (generated files, symlinks, fixtures)
+# need only be parsed once. descend() never writes to the nodes (visited
+# tracking is in Ctx), so cached trees can be handed out directly.
+_parse_cache = collections.OrderedDict()
+PARSE_CACHE_SIZE = 1000
+
+def _remember(key, tree):
+	_parse_cache[key] = tree
+	if len(_parse_cache) > PARSE_CACHE_SIZE: _parse_cache.popitem(last=False)
+
+# ------ tree-sitter to esprima adaptation ------
+# Tree-sitter names its node kinds and children quite differently from the
+# ESTree format that esprima produces. Rather than teach every handler both
+# vocabularies, wrap each tree-sitter node in a TSNode that answers to the
+# esprima attribute names. Only the kinds and attributes that the handlers
+# below actually use need to be mapped.
+
+_TSLoc = collections.namedtuple("Loc", ["start", "end"])
+_TSPos = collections.namedtuple("Pos", ["line", "column"])
+
+class _TSDoc:
+	"""Per-parse shared state: the source bytes, for offset translation
+
+	Tree-sitter measures in bytes where esprima measures in characters; for
+	pure-ASCII files (the overwhelmingly common case) they're the same."""
+	__slots__ = ("raw", "isascii")
+	def __init__(self, raw, isascii):
+		self.raw = raw
+		self.isascii = isascii
+	def to_char(self, offset):
+		if self.isascii: return offset
+		return len(self.raw[:offset].decode())
+
+class TSNode:
+	"""A tree-sitter node wearing esprima's attribute names
+
+	Attributes are computed on first access and then cached on the instance,
+	so repeated visits see stable objects (descend's dedup is by identity).
+	Anything not mapped for this node kind is None, which conveniently
+	matches esprima's answer-None-for-everything behaviour."""
+	def __init__(self, ts, doc, type, spec):
+		self._ts = ts
+		self._doc = doc
+		self.type = type
+		self._spec = spec
+	def __getattr__(self, name):
+		if name.startswith("__"): raise AttributeError(name)
+		ts, doc = self._ts, self._doc
+		fn = self._spec.get(name)
+		if fn is not None: val = fn(ts, doc)
+		elif name == "loc":
+			val = _TSLoc(_TSPos(ts.start_point[0] + 1, ts.start_point[1]),
+				_TSPos(ts.end_point[0] + 1, ts.end_point[1]))
+		elif name == "range":
+			val = (doc.to_char(ts.start_byte), doc.to_char(ts.end_byte))
+		else: val = None
+		setattr(self, name, val) # Cache it - identity matters to descend()
+		return val
+
+# Attribute getters. Each takes the raw tree-sitter node and the doc.
+def _text(ts, doc): return ts.text.decode()
+def _named(ts, doc): return [_w(c, doc) for c in ts.named_children if c.type != "comment"]
+def _first(ts, doc):
+	for c in ts.named_children:
+		if c.type != "comment": return _w(c, doc)
+def _field(name):
+	def get(ts, doc): return _w(ts.child_by_field_name(name), doc)
+	return get
+def _const(value):
+	def get(ts, doc): return value
+	return get
+def _arguments(ts, doc):
+	args = ts.child_by_field_name("arguments")
+	return _named(args, doc) if args is not None else []
+def _arrow_expression(ts, doc):
+	body = ts.child_by_field_name("body")
+	return body is not None and body.type != "statement_block"
+def _export_decl(ts, doc):
+	# export function f() ... has a declaration; export default expr has a value
+	decl = ts.child_by_field_name("declaration")
+	if decl is None: decl = ts.child_by_field_name("value")
+	return _w(decl, doc)
+def _declarations(ts, doc):
+	return [_w(c, doc) for c in ts.named_children if c.type == "variable_declarator"]
+def _case_body(ts, doc):
+	value = ts.child_by_field_name("value")
+	return [_w(c, doc) for c in ts.named_children if c.type != "comment" and c != value]
+def _string_value(ts, doc):
+	return "".join(c.text.decode() for c in ts.children if c.type in ("string_fragment", "escape_sequence"))
+def _method_value(ts, doc):
+	# esprima gives a method's function as a separate FunctionExpression node;
+	# tree-sitter hangs the body directly off the method_definition.
+	return TSNode(ts, doc, "FunctionExpression", _TS_KINDS["function_expression"][1])
+
+def _intern_text(ts, doc):
+	# Identifier names get looked up in scope dicts over and over; interned
+	# strings make those lookups a pointer compare with a pre-cached hash.
+	return sys.intern(ts.text.decode())
+
+_TS_IDENT = {"name": _intern_text}
+def _ident_self(ts, doc): return TSNode(ts, doc, "Identifier", _TS_IDENT)
+# Shorthand {x} is a single node in tree-sitter, but a Property whose key and
+# value are both the identifier in esprima. The latter shape is load-bearing
+# for import destructuring, so synthesize it.
+_TS_SHORTHAND = {"key": _ident_self, "value": _ident_self}
+def _properties(ts, doc):
+	props = []
+	for c in ts.named_children:
+		if c.type == "comment": continue
+		if c.type in ("shorthand_property_identifier", "shorthand_property_identifier_pattern"):
+			props.append(TSNode(c, doc, "Property", _TS_SHORTHAND))
+		else: props.append(_w(c, doc))
+	return props
+def _import_specs(ts, doc):
+	specs = []
+	for clause in ts.named_children:
+		if clause.type != "import_clause": continue
+		for spec in clause.named_children:
+			if spec.type == "identifier":
+				specs.append(TSNode(spec, doc, "ImportDefaultSpecifier", {"local": _ident_self}))
+			elif spec.type == "namespace_import":
+				for c in spec.named_children:
+					if c.type == "identifier":
+						specs.append(TSNode(c, doc, "ImportNamespaceSpecifier", {"local": _ident_self}))
+			elif spec.type == "named_imports":
+				for imp in spec.named_children:
+					if imp.type != "import_specifier": continue
+					local = imp.child_by_field_name("alias") or imp.child_by_field_name("name")
+					specs.append(TSNode(imp, doc, "ImportSpecifier",
+						{"local": _const(None) if local is None else lambda ts, doc, local=local: _w(local, doc)}))
+	return specs
+
+_body = _field("body")
+_TS_KINDS = {
+	"program": ("Program", {"body": _named}),
+	"import_statement": ("ImportDeclaration", {"specifiers": _import_specs}),
+	"lexical_declaration": ("VariableDeclaration", {"declarations": _declarations}),
+	"variable_declaration": ("VariableDeclaration", {"declarations": _declarations}),
+	"variable_declarator": ("VariableDeclarator", {"id": _field("name"), "init": _field("value")}),
+	"expression_statement": ("ExpressionStatement", {"expression": _first}),
+	"call_expression": ("CallExpression", {"callee": _field("function"), "arguments": _arguments}),
+	"new_expression": ("NewExpression", {"callee": _field("constructor"), "arguments": _arguments}),
+	"member_expression": ("MemberExpression", {"object": _field("object"), "property": _field("property"), "computed": _const(False)}),
+	"subscript_expression": ("MemberExpression", {"object": _field("object"), "property": _field("index"), "computed": _const(True)}),
+	"identifier": ("Identifier", _TS_IDENT),
+	"arrow_function": ("ArrowFunctionExpression", {"body": _body, "expression": _arrow_expression}),
+	"function_expression": ("FunctionExpression", {"id": _field("name"), "body": _body}),
+	"function": ("FunctionExpression", {"id": _field("name"), "body": _body}), # Older grammars
+	"generator_function": ("FunctionExpression", {"id": _field("name"), "body": _body}),
+	"function_declaration": ("FunctionDeclaration", {"id": _field("name"), "body": _body}),
+	"generator_function_declaration": ("FunctionDeclaration", {"id": _field("name"), "body": _body}),
+	"statement_block": ("BlockStatement", {"body": _named}),
+	"class_declaration": ("ClassDeclaration", {"id": _field("name"), "body": _body}),
+	"class": ("ClassDeclaration", {"id": _field("name"), "body": _body}),
+	"class_body": ("ClassBody", {"body": _named}),
+	"method_definition": ("MethodDefinition", {"key": _field("name"), "value": _method_value}),
+	"field_definition": ("PropertyDefinition", {"key": _field("property"), "value": _field("value")}),
+	"export_statement": ("ExportNamedDeclaration", {"declaration": _export_decl}),
+	"return_statement": ("ReturnStatement", {"argument": _first}),
+	"if_statement": ("IfStatement", {"consequent": _field("consequence"), "alternate": _field("alternative")}),
+	"ternary_expression": ("ConditionalExpression", {"consequent": _field("consequence"), "alternate": _field("alternative")}),
+	"switch_statement": ("SwitchStatement", {"cases": lambda ts, doc: _named(ts.child_by_field_name("body"), doc)}),
+	"switch_case": ("SwitchCase", {"consequent": _case_body}),
+	"switch_default": ("SwitchCase", {"consequent": _named}),
+	"try_statement": ("TryStatement", {"block": _body, "handler": _field("handler"), "finalizer": _field("finalizer")}),
+	"catch_clause": ("CatchClause", {"body": _body}),
+	"array": ("ArrayExpression", {"elements": _named}),
+	"object": ("ObjectExpression", {"properties": _properties}),
+	"object_pattern": ("ObjectPattern", {"properties": _properties}),
+	"array_pattern": ("ArrayPattern", {}),
+	"pair": ("Property", {"key": _field("key"), "value": _field("value")}),
+	"pair_pattern": ("Property", {"key": _field("key"), "value": _field("value")}),
+	"unary_expression": ("UnaryExpression", {"argument": _field("argument")}),
+	"await_expression": ("AwaitExpression", {"argument": _first}),
+	"spread_element": ("SpreadElement", {"argument": _first}),
+	"yield_expression": ("YieldExpression", {"argument": _first}),
+	"binary_expression": ("BinaryExpression", {"left": _field("left"), "right": _field("right")}),
+	"assignment_expression": ("AssignmentExpression", {"left": _field("left"), "right": _field("right")}),
+	"augmented_assignment_expression": ("AssignmentExpression", {"left": _field("left"), "right": _field("right")}),
+	"sequence_expression": ("SequenceExpression", {}),
+	"string": ("Literal", {"raw": _text, "value": _string_value}),
+	"template_string": ("TemplateLiteral", {}),
+	"regex": ("Literal", {"raw": _text}),
+	"number": ("Literal", {"raw": _text}),
+	"true": ("Literal", {}), "false": ("Literal", {}),
+	"null": ("Literal", {}), "undefined": ("Literal", {}),
+	"for_statement": ("ForStatement", {"body": _body}),
+	"for_in_statement": ("ForInStatement", {"body": _body}), # Also covers for-of
+	"while_statement": ("WhileStatement", {"body": _body}),
+	"do_statement": ("DoWhileStatement", {"body": _body}),
+	"labeled_statement": ("LabeledStatement", {"body": _body}),
+	"break_statement": ("BreakStatement", {}), "continue_statement": ("ContinueStatement", {}),
+	"empty_statement": ("EmptyStatement", {}), "debugger_statement": ("DebuggerStatement", {}),
+	"throw_statement": ("ThrowStatement", {}), "update_expression": ("UpdateExpression", {}),
+	"this": ("ThisExpression", {}), "super": ("Super", {}),
+}
+for kind in ("property_identifier", "shorthand_property_identifier",
+		"shorthand_property_identifier_pattern", "statement_identifier",
+		"private_property_identifier"):
+	_TS_KINDS[kind] = ("Identifier", _TS_IDENT)
+# Intern the esprima-style type names: the handler table's keys are interned
+# too, so every dispatch lookup compares pointers, not characters.
+_TS_KINDS = {kind: (sys.intern(type), spec) for kind, (type, spec) in _TS_KINDS.items()}
+
+# Nodes that esprima doesn't represent at all - look straight through them.
+# A computed_property_name is just a wrapper around the key expression.
+_TS_UNWRAP = {"parenthesized_expression", "else_clause", "finally_clause", "computed_property_name"}
+
+def _w(ts, doc):
+	"""Wrap a tree-sitter node (or None) for esprima-style consumption"""
+	if ts is None: return None
+	while ts.type in _TS_UNWRAP:
+		ts = next((c for c in ts.named_children if c.type != "comment"), None)
+		if ts is None: return None
+	type, spec = _TS_KINDS.get(ts.type) or (ts.type, _TS_EMPTY)
+	return TSNode(ts, doc, type, spec)
+_TS_EMPTY = { }
+
+if _ts_parser is not None:
+	# A report can only ever arise from (a) a call to an all-caps function,
+	# (b) a choc/lindt import destructure, or (c) a set_content call worth
+	# warning about. This query spots all three, and runs entirely in
+	# compiled code - far cheaper than walking the tree in Python to
+	# discover there's nothing to find.
+	try:
+		_ts_cursor = tree_sitter.QueryCursor # Query and QueryCursor grew this API in py-tree-sitter 0.25
+		_ts_interesting = tree_sitter.Query(_ts_lang, """
+		(call_expression function: (identifier) @call (#match? @call "^[A-Z]"))
+		(variable_declarator name: (object_pattern) value: (identifier) @import (#any-of? @import "choc" "lindt"))
+		(call_expression function: (identifier) @setc (#any-of? @setc "set_content" "replace_content"))
+		""")
+	except Exception: # Too old a tree_sitter to do things this way? Fall back to esprima.
+		_ts_parser = None
+
+def worth_scanning(module):
+	"""Quickly check whether a module could possibly produce a report"""
+	if not isinstance(module, TSNode): return True # esprima trees have no cheap prescan
+	caps = _ts_cursor(_ts_interesting).captures(module._ts)
+	return any(caps.values())
+
+def parse_module(fn, data, legacy=False):
+	"""Parse a module, reusing a previously-parsed tree if we have one"""
+	raw = data.encode()
+	use_ts = _ts_parser is not None and not legacy
+	key = (use_ts, hashlib.blake2b(raw, digest_size=16).digest())
+	if key in _parse_cache:
+		_parse_cache.move_to_end(key)
+		return _parse_cache[key]
+	if use_ts:
+		# No on-disk caching here: tree-sitter parses fast enough that the
+		# database would be pure overhead, and the wrappers hold C objects
+		# which can't be pickled anyway.
+		module = _w(_ts_parser.parse(raw).root_node, _TSDoc(raw, len(raw) == len(data)))
+		_remember(key, module)
+		return module
+	try: db = _ast_cache()
+	except (OSError, sqlite3.Error): db = None # No cache (eg unwritable home dir)? No problem. Parse every time.
+	path = os.path.abspath(fn)
+	sha = hashlib.sha256(raw).hexdigest()
+	if db:
+		row = db.execute("select tree from ast where path=? and sha=? and esprima=?",
+			(path, sha, esprima.version)).fetchone()
+		if row:
+			try: module = pickle.loads(row[0])
+			except Exception: module = None # Unreadable entry (eg different Python version)? Reparse and overwrite it.
+			if module is not None:
+				_remember(key, module)
+				return module
+	module = esprima.parseModule(data, {"loc": True, "range": True})
+	_remember(key, module)
+	if db:
+		db.execute("insert or replace into ast values (?, ?, ?, ?)",
+			(path, sha, esprima.version, pickle.dumps(module)))
+		db.commit()
+	return module
 
 elements = { }
 def element(f):
 	if f.__doc__:
-		for name in f.__doc__.split(): elements[name] = f
+		for name in f.__doc__.split(): elements[sys.intern(name)] = f
 	else:
-		elements[f.__name__] = f
+		elements[sys.intern(f.__name__)] = f
 	return f
 
-def descend(el, *, sc, **kw):
-	if not el: return
-	if isinstance(el, list):
-		for el in el: descend(el, sc=sc, **kw)
+_warned = set()
+def _unknown(el, *, ctx, scopes, sc, xmlns=""):
+	# Unrecognized element type. Warn the first time we see it, then ignore.
+	if el.type not in _warned:
+		_warned.add(el.type)
+		print("%s:%d: Unknown type: %s" % (ctx.fn, el.loc.start.line, el.type))
+
+_work = None # Elements queued for processing while a walk is active
+def descend(el, *, ctx, scopes, sc, xmlns=""):
+	"""Process an element and all of its children
+
+	Handlers call this for each child worth looking at. Rather than recursing
+	(one Python stack frame per AST level adds up fast, and deeply nested
+	code can blow the recursion limit), the child is queued, and the
+	outermost call loops until the queue and stack are both empty."""
+	global _work
+	if _work is not None:
+		_work.append((el, ctx, scopes, sc, xmlns))
 		return
-	# Any given element need only be visited once in any particular context
-	# Note that a list might have had more appended to it since it was last
-	# visited, so this check applies to the elements, not the whole list.
-	if getattr(el, "choc_visited_" + sc, False): return
-	setattr(el, "choc_visited_" + sc, True)
-
-	f = elements.get(el.type)
-	if f: f(el, sc=sc, **kw)
-	else:
-		print("%s:%d: Unknown type: %s" % (Ctx.fn, el.loc.start.line, el.type))
-		elements[el.type] = lambda el, **kw: None
+	_work = [(el, ctx, scopes, sc, xmlns)]
+	stack = []
+	_get = elements.get
+	_ignore = _IGNORED_TYPES
+	try:
+		while True:
+			if _work:
+				# Whatever a handler queued goes on top of the stack, in
+				# order, keeping the walk depth-first and left-to-right.
+				stack.extend(reversed(_work))
+				_work.clear()
+			if not stack: break
+			el, ctx, scopes, sc, xmlns = stack.pop()
+			if el is _POP_SCOPE:
+				# A function body just finished; close off its scope.
+				scopes.pop()
+				continue
+			if not el: continue
+			if isinstance(el, list):
+				stack.extend((item, ctx, scopes, sc, xmlns) for item in reversed(el))
+				continue
+			t = el.type
+			# Literals and friends vastly outnumber everything else; skip the
+			# dedup bookkeeping and the dispatch for anything with no handler work.
+			if t in _ignore: continue
+			if t == "MemberExpression" and el.object.type in _ignore: continue # "str".spam - nothing to find
+			# Any given element need only be visited once in any particular context
+			# Note that a list might have had more appended to it since it was last
+			# visited, so this check applies to the elements, not the whole list.
+			key = (id(el), sc)
+			if key in ctx.visited: continue
+			ctx.visited.add(key)
+			_get(t, _unknown)(el, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	finally:
+		_work = None
 
 # Recursive AST descent handlers
-# Each one receives the current element and a tuple of current scopes
+# Each one receives the current element and a list of current scopes
+
+# Functions push a scope for the duration of their body. Since the body is
+# processed off the work stack rather than by recursion, the scope can't be
+# popped on return from descend(); instead a sentinel is queued behind the
+# body, and pops the scope once the body's entire subtree has been walked.
+_POP_SCOPE = object()
 
 # On finding any sort of function, descend into it to probe.
 @element
-def FunctionExpression(el, *, scopes, sc, **kw):
+def FunctionExpression(el, *, ctx, scopes, sc, xmlns=""):
 	if sc != "return": sc = "" # If we're not *calling* the function, then just probe it, don't process its return value
-	descend(el.body, scopes=scopes + ({ },), sc=sc, **kw)
+	scopes.append({ })
+	descend(el.body, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(_POP_SCOPE, ctx=ctx, scopes=scopes, sc=sc)
 
 @element
-def ArrowFunctionExpression(el, *, scopes, sc, **kw):
+def ArrowFunctionExpression(el, *, ctx, scopes, sc, xmlns=""):
 	if sc == "return" and el.expression: # Braceless arrow functions implicitly return
-		descend(el.body, scopes=scopes + ({ },), sc="set_content", **kw)
-	else: FunctionExpression(el, scopes=scopes, sc=sc, **kw)
+		scopes.append({ })
+		descend(el.body, ctx=ctx, scopes=scopes, sc="set_content", xmlns=xmlns)
+		descend(_POP_SCOPE, ctx=ctx, scopes=scopes, sc=sc)
+	else: FunctionExpression(el, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def FunctionDeclaration(el, *, scopes, sc, **kw):
+def FunctionDeclaration(el, *, ctx, scopes, sc, xmlns=""):
 	if sc != "return" and el.id: scopes[-1].setdefault(el.id.name, []).append(el)
-	FunctionExpression(el, scopes=scopes, sc=sc, **kw)
+	FunctionExpression(el, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def BodyDescender(el, **kw):
+def BodyDescender(el, *, ctx, scopes, sc, xmlns=""):
 	"""BlockStatement LabeledStatement WhileStatement DoWhileStatement CatchClause
 	ForStatement ForInStatement ForOfStatement"""
-	descend(el.body, **kw)
+	descend(el.body, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def Ignore(el, **kw):
+def Ignore(el, *, ctx, scopes, sc, xmlns=""):
 	"""Literal RegExpLiteral Directive EmptyStatement DebuggerStatement ThrowStatement UpdateExpression
 	ImportExpression TemplateLiteral ContinueStatement BreakStatement ThisExpression ObjectPattern ArrayPattern"""
 	# I assume that template strings will be used only for strings, not for DOM elements.
+# The docstring above doubles as the list of types that descend() skips outright;
+# the handler stays registered, but is never actually called.
+_IGNORED_TYPES = frozenset(sys.intern(t) for t in Ignore.__doc__.split())
 
 @element
-def MemberExpression(el, **kw):
-	descend(el.object, **kw)
+def MemberExpression(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.object, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def Export(el, **kw):
+def Export(el, *, ctx, scopes, sc, xmlns=""):
 	"""ExportNamedDeclaration ExportDefaultDeclaration"""
-	descend(el.declaration, **kw)
+	descend(el.declaration, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def ImportDeclaration(el, **kw):
+def ImportDeclaration(el, *, ctx, scopes, sc, xmlns=""):
 	# Optionally check that Choc Factory has indeed been imported, and skip the file if not?
-	descend(el.specifiers, **kw)
+	descend(el.specifiers, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def ImportSpec(el, *, scopes, **kw):
+def ImportSpec(el, *, ctx, scopes, sc, xmlns=""):
 	"""ImportSpecifier ImportDefaultSpecifier ImportNamespaceSpecifier"""
 	scopes[-1].setdefault(el.local.name, []) # Mark that it's a known variable but don't attach any code to it
 
 @element
-def Identifier(el, *, scopes, sc, **kw):
+def Identifier(el, *, ctx, scopes, sc, xmlns=""):
 	if sc in ("set_content", "return"):
-		while scopes:
-			*scopes, scope = scopes
-			if el.name in scope:
-				descend(scope[el.name], scopes=(*scopes, scope), sc=sc, **kw)
+		for i in range(len(scopes) - 1, -1, -1):
+			code = scopes[i].get(el.name)
+			if code is not None: # An empty list still counts as found (eg an import)
+				# Code attached to the name runs in its own scope context, so
+				# hand it a copy of the chain truncated to that point.
+				descend(code, ctx=ctx, scopes=scopes[:i + 1], sc=sc, xmlns=xmlns)
 				break
 
 @element
-def Call(el, *, scopes, sc, **kw):
+def Call(el, *, ctx, scopes, sc, xmlns=""):
 	"""CallExpression NewExpression"""
 	if el.callee.type == "Identifier":
 		funcname = el.callee.name
-		prev = kw.get("xmlns", "(none)")
-		xmlns = Ctx.import_namespaces.get(funcname, DEFAULT_NAMESPACES.get(funcname, kw.pop("xmlns", ""))) # Be sure that xmlns is always popped out
-		descend(el.arguments, scopes=scopes, sc=sc, xmlns=xmlns, **kw)
+		xmlns = ctx.import_namespaces.get(funcname, DEFAULT_NAMESPACES.get(funcname, xmlns)) # The namespace applies to this call's args, nothing beyond
+		descend(el.arguments, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 		if funcname in ("set_content", "replace_content"):
 			# Alright! We're setting content. First arg is the target, second is the content.
 			# Note that we don't validate mismatches of choc/replace_content or lindt/set_content.
 			if len(el.arguments) < 2: return # Huh. Need two args. Whatever.
-			descend(el.arguments[1], scopes=scopes, sc="set_content", **kw)
+			descend(el.arguments[1], ctx=ctx, scopes=scopes, sc="set_content")
 			if len(el.arguments) > 2:
 				print("%s:%d: Extra arguments to set_content - did you intend to pass an array?" %
-					(Ctx.fn, el.loc.start.line), file=sys.stderr)
-				print(Ctx.source_lines[el.loc.start.line - 1], file=sys.stderr)
+					(ctx.fn, el.loc.start.line), file=sys.stderr)
+				print(ctx.source_line(el.loc.start.line), file=sys.stderr)
 		if sc == "set_content":
 			for scope in reversed(scopes):
-				if funcname in scope:
+				code = scope.get(funcname)
+				if code is not None:
 					# Descend into the function. It's possible we've already scanned it
 					# for actual set_content calls, but now we will scan it for return
 					# values as well. (If we've already scanned for return values, this
 					# will quickly return.)
-					descend(scope[funcname], scopes=scopes[:1], sc="return", **kw)
+					descend(code, ctx=ctx, scopes=scopes[:1], sc="return")
 					return
 			# Note that a NewExpression will never be a Choc Factory call
 			if funcname.isupper() and el.type == "CallExpression":
 				if xmlns:
 					fn = NAMESPACE_XFRM.get(xmlns)
-					Ctx.want_imports[funcname] = '"' + xmlns + ':' + (fn(funcname) if fn else funcname) + '"';
-					if funcname not in Ctx.import_namespaces: Ctx.import_namespaces[funcname] = xmlns
-				else: Ctx.want_imports[funcname] = funcname
+					ctx.want_namespaced[funcname] = '"' + xmlns + ':' + (fn(funcname) if fn else funcname) + '"';
+					if funcname not in ctx.import_namespaces: ctx.import_namespaces[funcname] = xmlns
+				else: ctx.want_imports.add(funcname)
 		return
-	descend(el.arguments, scopes=scopes, sc=sc, **kw) # Assume a function's arguments can be incorporated into its return value
+	descend(el.arguments, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns) # Assume a function's arguments can be incorporated into its return value
 	if el.callee.type == "MemberExpression":
 		c = el.callee
-		descend(c.object, scopes=scopes, sc="return" if sc == "set_content" else sc, **kw) # "foo(...).spam()" starts out by calling "foo(...)"
-		if c.computed: descend(c.property, scopes=scopes, sc=sc, **kw) # "foo[x]()" starts out by evaluating x
+		descend(c.object, ctx=ctx, scopes=scopes, sc="return" if sc == "set_content" else sc, xmlns=xmlns) # "foo(...).spam()" starts out by calling "foo(...)"
+		if c.computed: descend(c.property, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns) # "foo[x]()" starts out by evaluating x
 		elif c.property.name in DOM_ADDITION_METHODS:
-			descend(el.arguments, scopes=scopes, sc="set_content", **kw)
+			descend(el.arguments, ctx=ctx, scopes=scopes, sc="set_content", xmlns=xmlns)
 		elif c.property.name == "map":
 			# stuff.map(e => ...) is effectively a call to that function.
 			if sc == "set_content": sc = "return"
-			descend(el.arguments[0], scopes=scopes, sc=sc, **kw)
+			descend(el.arguments[0], ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 		elif c.property.name in ("push", "unshift"):
 			# Adding to an array is adding code to the definition of the array.
 			# For static analysis, we consider both of these to have multiple code
@@ -185,69 +567,70 @@ def Call(el, *, scopes, sc, **kw):
 			if c.object.type == "Identifier":
 				name = c.object.name
 				for scope in reversed(scopes):
-					if name in scope:
-						scope[name].append(el.arguments)
+					code = scope.get(name)
+					if code is not None:
+						code.append(el.arguments)
 						return
 	elif el.callee.type == "ArrowFunctionExpression" or el.callee.type == "FunctionExpression":
 		# Function expression, immediately called. Might also be being named.
-		descend(el.callee, scopes=scopes, sc="return" if sc == "set_content" else sc, **kw)
+		descend(el.callee, ctx=ctx, scopes=scopes, sc="return" if sc == "set_content" else sc, xmlns=xmlns)
 	# else: pass # For now, I'm ignoring any unrecognized x.y() or x()() or anything
 
 @element
-def ReturnStatement(el, *, sc, **kw):
+def ReturnStatement(el, *, ctx, scopes, sc, xmlns=""):
 	if sc == "return": sc = "set_content"
-	descend(el.argument, sc=sc, **kw)
+	descend(el.argument, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def ExpressionStatement(el, **kw):
-	descend(el.expression, **kw)
+def ExpressionStatement(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.expression, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def If(el, **kw):
+def If(el, *, ctx, scopes, sc, xmlns=""):
 	"""IfStatement ConditionalExpression"""
-	descend(el.consequent, **kw)
-	descend(el.alternate, **kw)
+	descend(el.consequent, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(el.alternate, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def SwitchStatement(el, **kw):
-	descend(el.cases, **kw)
+def SwitchStatement(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.cases, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 @element
-def SwitchCase(el, **kw):
-	descend(el.consequent, **kw)
+def SwitchCase(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.consequent, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def TryStatement(el, **kw):
-	descend(el.block, **kw)
-	descend(el.handler, **kw)
-	descend(el.finalizer, **kw)
+def TryStatement(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.block, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(el.handler, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(el.finalizer, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def ArrayExpression(el, **kw):
-	descend(el.elements, **kw)
+def ArrayExpression(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.elements, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def ObjectExpression(el, **kw):
-	descend(el.properties, **kw)
+def ObjectExpression(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.properties, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 @element
-def Property(el, **kw):
-	descend(el.key, **kw)
-	descend(el.value, **kw)
+def Property(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.key, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(el.value, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def Unary(el, **kw):
+def Unary(el, *, ctx, scopes, sc, xmlns=""):
 	"""UnaryExpression AwaitExpression SpreadElement YieldExpression"""
-	descend(el.argument, **kw)
+	descend(el.argument, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def Binary(el, **kw):
+def Binary(el, *, ctx, scopes, sc, xmlns=""):
 	"""BinaryExpression LogicalExpression"""
-	descend(el.left, **kw)
-	descend(el.right, **kw)
+	descend(el.left, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(el.right, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def VariableDeclaration(el, *, scopes, **kw):
-	if el.loc and el.loc.start.line <= Ctx.autoimport_line and el.loc.end.line >= Ctx.autoimport_line:
-		Ctx.autoimport_range = el.range
+def VariableDeclaration(el, *, ctx, scopes, sc, xmlns=""):
+	if el.loc and el.loc.start.line <= ctx.autoimport_line and el.loc.end.line >= ctx.autoimport_line:
+		ctx.autoimport_range = el.range
 	for decl in el.declarations:
 		if decl.init:
 			if decl.init.type == "Identifier" and decl.init.name in ("choc", "lindt"):
@@ -257,22 +640,22 @@ def VariableDeclaration(el, *, scopes, **kw):
 					if prop.value.type == "Identifier" and prop.value.name.isupper():
 						if prop.key.type == "Identifier":
 							source = prop.key.name
-							Ctx.import_namespaces[prop.value.name] = ""
+							ctx.import_namespaces[prop.value.name] = ""
 						elif prop.key.type == "Literal":
 							source = prop.key.raw
-							Ctx.import_namespaces[prop.value.name] = prop.key.value.rpartition(":")[0]
+							ctx.import_namespaces[prop.value.name] = prop.key.value.rpartition(":")[0]
 						else: print("Unrecognized import destructuring type " + prop.key.type)
-						Ctx.got_imports[prop.value.name] = source
-				Ctx.import_source = decl.init.name
+						ctx.got_imports[prop.value.name] = source
+				ctx.import_source = decl.init.name
 				continue
 			# Descend into it, looking for functions; also save it in case it's used later.
-			descend(decl.init, scopes=scopes, **kw)
+			descend(decl.init, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 			scopes[-1].setdefault(decl.id.name, []).append(decl.init)
 
 @element
-def AssignmentExpression(el, *, scopes, sc, **kw):
-	descend(el.left, scopes=scopes, sc=sc, **kw)
-	descend(el.right, scopes=scopes, sc=sc, **kw)
+def AssignmentExpression(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.left, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(el.right, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 	if el.left.type != "Identifier" or sc == "set_content": return
 	# Assigning to a simple name stashes the expression in the appropriate scope.
 	# NOTE: In some situations, an assignment "further down" than the corresponding set_content
@@ -283,29 +666,40 @@ def AssignmentExpression(el, *, scopes, sc, **kw):
 	# It MAY be better to replicate it across all the names.
 	name = el.left.name
 	for scope in reversed(scopes):
-		if name in scope:
-			scope[name].append(el.right)
+		code = scope.get(name)
+		if code is not None:
+			code.append(el.right)
 			return
 	# If we didn't find anything to assign to, it's probably landing at top-level. Warn?
 	scopes[0][name] = [el.right]
 
 @element
-def ClassDeclaration(el, **kw):
-	descend(el.id, **kw)
-	descend(el.body, **kw)
+def ClassDeclaration(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.id, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(el.body, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def ClassBody(el, **kw):
-	descend(el.body, **kw)
+def ClassBody(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.body, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
 
 @element
-def MethodDefinition(el, **kw):
-	descend(el.key, **kw)
-	descend(el.value, **kw)
-
-def process(fn, *, fix=False, extcall=()):
-	Ctx.reset(fn)
-	if fn != "-":
+def MethodDefinition(el, *, ctx, scopes, sc, xmlns=""):
+	descend(el.key, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+	descend(el.value, ctx=ctx, scopes=scopes, sc=sc, xmlns=xmlns)
+
+_file_cache = { } # fn -> (mtime, Ctx) - library callers (editor plugins, watch scripts) rescan files a lot
+def process(fn, *, fix=False, extcall=(), legacy_parser=False, data=None):
+	mtime = None
+	if data is None and fn != "-" and not fix:
+		# An unchanged mtime means an unchanged result. Don't bother under
+		# --fix, since fixing the file would invalidate the entry anyway.
+		try: mtime = os.stat(fn).st_mtime
+		except OSError: pass
+		cached = _file_cache.get(fn)
+		if cached and cached[0] == mtime: return cached[1]
+	ctx = Ctx(fn)
+	if data is not None: pass # Caller read the file for us (see prefetch in main)
+	elif fn != "-":
 		with open(fn) as f: data = f.read()
 	else: data = """
 	import choc, {set_content, on, DOM} from "https://rosuav.github.io/choc/factory.js";
@@ -322,56 +716,82 @@ def process(fn, *, fix=False, extcall=()):
 	export function COMPONENT(x) {return FIGURE(x.name);}
 	function NONCOMPONENT(x) {return FIGCAPTION(x.name);} //Non-exported won't be detected unless called
 	"""
-	module = esprima.parseModule(data, {"loc": True, "range": True})
-	Ctx.source_lines = data.split("\n")
-	for i, line in enumerate(Ctx.source_lines):
-		if line.strip().endswith("autoimport"):
-			Ctx.autoimport_line = i + 1
-			break
-	# First pass: Collect top-level function declarations (the ones that get hoisted)
-	scope = { }
-	exporteds = []
-	for el in module.body:
-		# Anything exported, just look at the base thing
-		exported = el.type in ("ExportNamedDeclaration", "ExportDefaultDeclaration")
-		if exported:
-			el = el.declaration
-			if not el: continue # Possibly a reexport or something
-		# function func(x) {y}
-		if el.type == "FunctionDeclaration" and el.id:
-			scope[el.id.name] = [el]
-			# export function COMPONENT() { }
-			if exported and el.id.name.isupper(): exporteds.append(el)
-	# Second pass: Recursively look for all set_content calls.
-	descend(module.body, scopes=(scope,), sc="")
-	# Some exported functions can return DOM elements. It's possible that they've
-	# already been scanned, but that's okay, we'll deduplicate in descend().
-	for func in extcall or ():
-		if func in scope: descend(scope[func], scopes=(scope,), sc="return")
-	descend(exporteds, scopes=(scope,), sc="return");
-	have = sorted(Ctx.got_imports)
-	want = sorted(Ctx.want_imports)
-	if want != Ctx.got_imports:
+	# A file that never mentions choc or lindt can't need any imports, so
+	# don't even parse it - two C-speed substring scans reject it. With
+	# --extcall we can't be sure (the named function might be defined here
+	# without touching choc directly), so scan regardless.
+	if "choc" not in data and "lindt" not in data and not extcall:
+		if mtime is not None: _file_cache[fn] = (mtime, ctx)
+		return ctx
+	module = parse_module(fn, data, legacy_parser)
+	ctx.source = data
+	# Find the first line ending with "autoimport" (trailing whitespace ok).
+	# One C-level scan rather than splitting and checking every line.
+	m = re.search(r"autoimport[ \t\r\f\v]*$", data, re.M)
+	if m: ctx.autoimport_line = data.count("\n", 0, m.start()) + 1
+	if worth_scanning(module):
+		# First pass: Collect top-level function declarations (the ones that get hoisted)
+		scope = { }
+		exporteds = []
+		for el in module.body:
+			# Anything exported, just look at the base thing
+			exported = el.type in ("ExportNamedDeclaration", "ExportDefaultDeclaration")
+			if exported:
+				el = el.declaration
+				if not el: continue # Possibly a reexport or something
+			# function func(x) {y}
+			if el.type == "FunctionDeclaration" and el.id:
+				scope[el.id.name] = [el]
+				# export function COMPONENT() { }
+				if exported and el.id.name.isupper(): exporteds.append(el)
+		# Second pass: Recursively look for all set_content calls.
+		descend(module.body, ctx=ctx, scopes=[scope], sc="")
+		# Some exported functions can return DOM elements. It's possible that they've
+		# already been scanned, but that's okay, we'll deduplicate in descend().
+		for func in extcall or ():
+			if func in scope: descend(scope[func], ctx=ctx, scopes=[scope], sc="return")
+		descend(exporteds, ctx=ctx, scopes=[scope], sc="return");
+	have = sorted(ctx.got_imports)
+	want_all = ctx.want_imports | ctx.want_namespaced.keys()
+	want = sorted(want_all)
+	if want != have:
 		print(fn)
-		lose = [x for x in have if x not in Ctx.want_imports]
-		gain = [x for x in want if x not in Ctx.got_imports]
+		lose = [x for x in have if x not in want_all]
+		gain = [x for x in want if x not in ctx.got_imports]
 		if lose: print("LOSE:", lose)
 		if gain: print("GAIN:", gain)
 		wanted = []
 		for func in want:
-			prev = Ctx.got_imports.get(func, Ctx.want_imports[func]);
+			prev = ctx.got_imports.get(func, ctx.want_namespaced.get(func, func));
 			if prev == func: wanted.append(func)
 			else: wanted.append(prev + ": " + func)
 		wanted = ", ".join(wanted)
 		print("WANT:", wanted)
-		if Ctx.autoimport_range:
-			start, end = Ctx.autoimport_range
-			data = data[:start] + "const {" + wanted + "} = " + Ctx.import_source + ";" + data[end:]
+		if ctx.autoimport_range:
+			start, end = ctx.autoimport_range
+			newdata = data[:start] + "const {" + wanted + "} = " + ctx.import_source + ";" + data[end:]
 			# Write-back if the user wants it
-			if fn == "-": print(data)
-			if fix:
-				with open(fn, "w") as f:
-					f.write(data)
+			if fn == "-": print(newdata)
+			if fix and newdata != data:
+				# Write the whole file aside and swap it into place, so a crash
+				# mid-write can't leave a truncated file behind; and if nothing
+				# actually changed, don't touch the file at all (no mtime bump,
+				# no inotify noise for anything watching the directory).
+				tmp = fn + ".tmp"
+				with open(tmp, "w") as f:
+					f.write(newdata)
+				os.replace(tmp, fn)
+	if mtime is not None: _file_cache[fn] = (mtime, ctx)
+	return ctx
+
+def _process_buffered(fn, **args):
+	# Worker-side wrapper: buffer all output so the parent can print it in
+	# order, rather than interleaving messages from parallel workers.
+	import io, contextlib
+	out, err = io.StringIO(), io.StringIO()
+	with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+		process(fn, **args)
+	return out.getvalue(), err.getvalue()
 
 def main(args):
 	import argparse
@@ -379,8 +799,29 @@ def main(args):
 	p.add_argument("file", nargs="+", help="File(s) to process")
 	p.add_argument("--fix", action="store_true", help="Fix any discrepancies automatically")
 	p.add_argument("--extcall", action="append", help="Identify an externally-called DOM generation function")
+	p.add_argument("--legacy-parser", action="store_true", help="Parse with esprima even if tree-sitter is available")
 	args = vars(p.parse_args(args))
 	files = args.pop("file")
-	for fn in files: process(fn, **args)
+	if len(files) > 1 and (os.cpu_count() or 1) > 1:
+		# Each file is parsed and probed completely independently, so fan the
+		# work out across all cores. Workers write their own files under --fix.
+		import concurrent.futures, functools
+		with concurrent.futures.ProcessPoolExecutor() as ex:
+			for out, err in ex.map(functools.partial(_process_buffered, **args), files):
+				sys.stderr.write(err) # Warnings happen during the scan, so show them first
+				sys.stdout.write(out)
+	else:
+		# Running serially - overlap reading the next file with processing the
+		# current one, so disk latency hides behind parse time.
+		import concurrent.futures
+		def read(fn):
+			if fn == "-": return None # process() supplies its own demo text
+			with open(fn) as f: return f.read()
+		with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
+			future = ex.submit(read, files[0])
+			for i, fn in enumerate(files):
+				data = future.result()
+				if i + 1 < len(files): future = ex.submit(read, files[i + 1])
+				process(fn, data=data, **args)
 
 if __name__ == "__main__": main(sys.argv[1:])